@@ -5,304 +5,1258 @@ Supports: OpenAI DALL-E, Grok, Stability AI, Replicate, Together AI
 """
 
 import os
-import requests
+import re
+import httpx
 import json
 from datetime import datetime
 from pathlib import Path
 import time
+import random
 import base64
-from typing import Optional, Dict, Any
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import functools
+import weakref
+import importlib.util
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Any, List, Callable, Union, Tuple
 
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    HTTP2 = True
+except ImportError:  # HTTP/1.1 keep-alive otherwise: pip install "httpx[http2]"
+    HTTP2 = False
 
-class UniversalImageGenerator:
-    def __init__(self, download_folder="ai_generated_images"):
-        """Initialize the Universal Image Generator"""
-        self.download_folder = download_folder
-        self.providers = {}
-        Path(self.download_folder).mkdir(parents=True, exist_ok=True)
-        print(f"✓ Download folder: {self.download_folder}")
-    
-    def add_provider(self, provider_name: str, api_key: str):
-        """Add an API provider"""
-        self.providers[provider_name.lower()] = api_key
-        print(f"✓ Added provider: {provider_name}")
+try:
+    import hishel
+    from hishel.httpx import SyncCacheTransport, AsyncCacheTransport
+except ImportError:  # optional on-disk cache for image downloads: pip install hishel
+    hishel = None
+
+try:
+    from aiolimiter import AsyncLimiter
+except ImportError:  # batch generation needs: pip install aiolimiter
+    AsyncLimiter = None
+
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:  # optional, faster JSON encode/decode: pip install orjson
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+    _loads = json.loads
+
+try:
+    import numpy as np
+except ImportError:  # prompt cache needs: pip install numpy sentence-transformers
+    np = None
+
+# sentence-transformers pulls in torch, so it is only imported once the
+# prompt cache first embeds something
+HAS_EMBEDDER = np is not None and importlib.util.find_spec("sentence_transformers") is not None
+
+try:
+    import faiss
+except ImportError:  # optional, numpy is used for the similarity search otherwise
+    faiss = None
+
+try:
+    from sklearn.cluster import MiniBatchKMeans
+except ImportError:  # optional, cache eviction falls back to usage counts only
+    MiniBatchKMeans = None
+
+
+# Timeouts in seconds; generation calls wait on remote inference
+POST_TIMEOUT = httpx.Timeout(connect=10, read=120, write=10, pool=5)
+GET_TIMEOUT = httpx.Timeout(connect=10, read=60, write=10, pool=5)
+POLL_TIMEOUT = httpx.Timeout(connect=5, read=30, write=10, pool=5)
+HTTP_LIMITS = httpx.Limits(max_connections=16, max_keepalive_connections=16)
+
+# Cached image downloads expire after a day
+HTTP_CACHE_TTL = 86400
+# Kept out of the download folder: cached responses duplicate the image bytes
+HTTP_CACHE_PATH = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache",
+                       "universal_ai_image_generator", "http_cache.db")
+
+# Prompts outside this length range are rejected before any API call
+MIN_PROMPT_LENGTH = 3
+MAX_PROMPT_LENGTH = 4000
+
+# Download/decode block size; a multiple of 4 so base64 slices decode cleanly
+CHUNK_SIZE = 65536
+
+# Filename sanitizer: keep ASCII letters, digits, '_', '-' and spaces
+_SAFE_RE = re.compile(r'[^\w \-]+', re.ASCII)
+_SPACE_TBL = str.maketrans(' ', '_')
+
+# Saved images end in a request key, e.g. ..._openai_a_cat_3f2a9c0d1e4b5a67.png
+_KEY_RE = re.compile(r'_([0-9a-f]{16})\.png$')
+
+# Replicate prediction polling: first poll after ~0.5s, growing to 10s
+POLL_INITIAL_DELAY = 0.5
+POLL_MAX_DELAY = 10.0
+POLL_MAX_ATTEMPTS = 120
+
+# Batch requests answered with HTTP 429 are retried up to RETRY_ATTEMPTS
+# times, waiting Retry-After (default RETRY_BACKOFF * 2**attempt) seconds
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF = 5.0
+
+# Published requests-per-minute limits used to pace batch generation
+DEFAULT_RATE_LIMITS = {
+    'openai': 50,
+    'grok': 60,
+    'stability': 150,
+    'replicate': 600,
+    'together': 60
+}
+
+
+def _retry_after(headers, default: float = 0.0) -> float:
+    """Seconds requested by a Retry-After header, or default"""
+    try:
+        return float(headers.get('Retry-After', default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _next_poll_delay(delay: float, headers) -> float:
+    """Grow the polling delay, honouring a Retry-After header if present"""
+    delay = min(delay * 1.6, POLL_MAX_DELAY)
+    return max(delay, _retry_after(headers))
+
+
+def _poll_busy(response) -> bool:
+    """True if a status poll was throttled or hit a server error (poll again)"""
+    return response.status_code == 429 or response.status_code >= 500
+
+
+class RetryNeeded(Exception):
+    """A provider rejected a request with HTTP 429; retry after delay seconds"""
+
+    def __init__(self, provider: str, delay: float):
+        super().__init__(f"{provider} rate limit hit (HTTP 429)")
+        self.delay = delay
+
+
+# Failures a provider call can raise: transport/HTTP status errors, bad
+# URLs (httpx.InvalidURL is not an HTTPError), 429 retries running out, and
+# malformed JSON bodies (decode errors are ValueErrors, missing fields
+# KeyError/IndexError/TypeError)
+PROVIDER_ERRORS = (httpx.HTTPError, httpx.InvalidURL, RetryNeeded,
+                   ValueError, KeyError, IndexError, TypeError)
+# Failures while saving an image: HTTP errors, bad or missing image URLs
+# (InvalidURL, TypeError for None), disk errors, bad base64
+DOWNLOAD_ERRORS = (httpx.HTTPError, httpx.InvalidURL, TypeError, OSError, ValueError)
+
+
+if AsyncLimiter is not None:
+    class AdaptiveLimiter(AsyncLimiter):
+        """Leaky-bucket limiter that slows down when a provider returns 429
+
+        adjust_down() cuts the rate by 20%; adjust_up() is called on every
+        success and restores 10% after a run of successes, never exceeding
+        the configured rate.
+        """
+        RAMP_UP_AFTER = 10
+
+        def __init__(self, max_rate: float, time_period: float = 60):
+            super().__init__(max_rate, time_period)
+            self.ceiling = max_rate
+            self.successes = 0
+
+        def _set_rate(self, max_rate: float):
+            self.max_rate = max_rate
+            self._rate_per_sec = max_rate / self.time_period
+
+        def adjust_down(self):
+            self.successes = 0
+            self._set_rate(max(1.0, self.max_rate * 0.8))
+
+        def adjust_up(self):
+            self.successes += 1
+            if self.successes >= self.RAMP_UP_AFTER and self.max_rate < self.ceiling:
+                self.successes = 0
+                self._set_rate(min(self.ceiling, self.max_rate * 1.1))
+else:
+    AdaptiveLimiter = None
+
+
+def _clean_prompt(prompt: Optional[str]) -> Optional[str]:
+    """Return the stripped prompt, or None if no provider would accept it"""
+    p = (prompt or "").strip()
+    if not MIN_PROMPT_LENGTH <= len(p) <= MAX_PROMPT_LENGTH:
+        print(f"❌ Invalid prompt length ({len(p)}, expected "
+              f"{MIN_PROMPT_LENGTH}-{MAX_PROMPT_LENGTH} characters)")
+        return None
+    if not any(c.isalpha() for c in p):
+        print("❌ Invalid prompt: no words to draw")
+        return None
+    return p
+
+
+def _json(response) -> Any:
+    """Decode a JSON response body (orjson when installed)"""
+    return _loads(response.content)
+
+
+def _safe_name(prompt: str) -> str:
+    """Filename-safe form of the first 50 characters of a prompt"""
+    return _SAFE_RE.sub('', prompt[:50]).strip().translate(_SPACE_TBL)
+
+
+@contextmanager
+def _open_image(filepath: str):
+    """Open an image file as a raw descriptor, bypassing Python's write buffer"""
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+    fd = os.open(filepath, flags, 0o644)
+    try:
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def _write_all(fd: int, data: bytes):
+    """Write a whole buffer to fd; memoryview slices avoid copying on short writes"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _write_base64(fd: int, data: str):
+    """Decode base64 image data into an open file one block at a time"""
+    for i in range(0, len(data), CHUNK_SIZE):
+        _write_all(fd, base64.b64decode(data[i:i + CHUNK_SIZE]))
+
+
+def _save_inline(result: Dict, filepath: str) -> bool:
+    """Write a result that carries its image bytes (raw or base64) to disk
+
+    Returns False when the result has no inline image data.
+    """
+    if 'raw' in result:
+        with _open_image(filepath) as fd:
+            _write_all(fd, result['raw'])
+    elif 'base64' in result:
+        print(f"⬇️  Decoding...")
+        with _open_image(filepath) as fd:
+            _write_base64(fd, result['base64'])
+    else:
+        print("❌ No image data")
+        return False
+    return True
+
+
+def _remove_partial(filepath: Optional[str]):
+    """Delete a half-written image after a failed download"""
+    if filepath and os.path.exists(filepath):
+        os.remove(filepath)
+
+
+def _delete_image(filepath: str):
+    """Delete a saved image, if it is still there"""
+    try:
+        os.remove(filepath)
+    except FileNotFoundError:
+        pass
+
+
+def _build_openai(prompt: str, model: str, size="1024x1024",
+                  quality="standard", style="vivid") -> Dict:
+    payload = {
+        "model": model,
+        "prompt": prompt,
+        "n": 1,
+        "size": size
+    }
     
-    def generate_openai(self, prompt: str, model="dall-e-3", size="1024x1024", 
-                       quality="standard", style="vivid") -> Optional[Dict]:
-        """Generate image using OpenAI DALL-E"""
-        if 'openai' not in self.providers:
-            print("❌ OpenAI API key not configured")
-            return None
-        
-        headers = {
-            "Authorization": f"Bearer {self.providers['openai']}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "model": model,
+    if model == "dall-e-3":
+        payload["quality"] = quality
+        payload["style"] = style
+    return payload
+
+
+def _build_grok(prompt: str, model: str, size="1024x1024",
+                quality="medium", style="natural") -> Dict:
+    return {
+        "model": model,
+        "prompt": prompt,
+        "n": 1,
+        "size": size,
+        "quality": quality,
+        "style": style
+    }
+
+
+def _build_stability(prompt: str, model: str, width=1024, height=1024,
+                     steps=30, cfg_scale=7) -> Dict:
+    return {
+        "text_prompts": [{"text": prompt}],
+        "cfg_scale": cfg_scale,
+        "height": height,
+        "width": width,
+        "steps": steps,
+        "samples": 1
+    }
+
+
+def _build_replicate(prompt: str, model: str, width=1024, height=1024,
+                     num_inference_steps=25) -> Dict:
+    return {
+        "version": model,
+        "input": {
             "prompt": prompt,
-            "n": 1,
-            "size": size
+            "width": width,
+            "height": height,
+            "num_inference_steps": num_inference_steps
         }
+    }
+
+
+def _build_together(prompt: str, model: str, width=1024, height=1024, steps=4) -> Dict:
+    return {
+        "model": model,
+        "prompt": prompt,
+        "width": width,
+        "height": height,
+        "steps": steps,
+        "n": 1
+    }
+
+
+def _parse_replicate(data: Dict) -> Dict:
+    output = data['output']
+    return {'url': output[0] if isinstance(output, list) else output}
+
+
+@dataclass(frozen=True)
+class ProviderSpec:
+    """How to call one provider's text-to-image endpoint"""
+    label: str                      # name shown in messages
+    url: str                        # endpoint, may contain {model}
+    auth: str                       # Authorization header scheme
+    model: str                      # default model
+    build: Callable[..., Dict]      # (prompt, model, **settings) -> payload
+    parse: Callable[[Dict], Dict]   # JSON response -> {'url': ...} or {'base64': ...}
+    headers: Dict[str, str] = field(default_factory=dict)
+    poll: bool = False              # response is a prediction to poll
+
+
+_PROVIDERS = {
+    'openai': ProviderSpec(
+        label="OpenAI",
+        url="https://api.openai.com/v1/images/generations",
+        auth="Bearer",
+        model="dall-e-3",
+        build=_build_openai,
+        parse=lambda d: {'url': d['data'][0]['url']}
+    ),
+    'grok': ProviderSpec(
+        label="Grok",
+        url="https://api.x.ai/v1/images/generations",
+        auth="Bearer",
+        model="grok-2-vision-1212",
+        build=_build_grok,
+        parse=lambda d: {'url': d['data'][0]['url']}
+    ),
+    'stability': ProviderSpec(
+        label="Stability AI",
+        url="https://api.stability.ai/v1/generation/{model}/text-to-image",
+        auth="Bearer",
+        model="stable-diffusion-xl-1024-v1-0",
+        build=_build_stability,
+        parse=lambda d: {'base64': d['artifacts'][0]['base64']},
+        headers={"Accept": "image/png"}
+    ),
+    'replicate': ProviderSpec(
+        label="Replicate",
+        url="https://api.replicate.com/v1/predictions",
+        auth="Token",
+        model="stability-ai/sdxl",
+        build=_build_replicate,
+        parse=_parse_replicate,
+        poll=True
+    ),
+    'together': ProviderSpec(
+        label="Together AI",
+        url="https://api.together.xyz/v1/images/generations",
+        auth="Bearer",
+        model="black-forest-labs/FLUX.1-schnell",
+        build=_build_together,
+        parse=lambda d: {'url': d['data'][0]['url']}
+    ),
+}
+
+
+class PromptCache:
+    """Approximate prompt -> image cache
+
+    Prompts are embedded with a sentence-transformers model and matched by
+    cosine similarity, so re-running a near-identical prompt with the same
+    settings returns the image already on disk instead of calling the API.
+    Rows live in <download_folder>/.cache.db; the in-memory search index is
+    rebuilt from the stored embeddings on start.
+
+    With max_bytes set, a background thread keeps the cached images under
+    that size using least-cost-under-usage eviction: embeddings are
+    clustered, and entries that are rarely hit and far from every cluster
+    centre are deleted first, keeping the semantically central ones.
+    """
+    EVICT_EVERY = 50        # inserts between eviction checks
+    N_CLUSTERS = 64         # upper bound; about one cluster per 10 rows
+    MIN_CLUSTER_ROWS = 100  # below this, usage counts alone decide
+
+    def __init__(self, folder: str, threshold: float = 0.92,
+                 model_name: str = "all-MiniLM-L6-v2",
+                 max_bytes: Optional[int] = None):
+        self.threshold = threshold
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        # Shared by compare_providers() worker threads and the maintainer;
+        # guards the db and indexes. Model calls take _embed_lock instead so
+        # searches and inserts never queue behind inference.
+        self._lock = threading.Lock()
+        self._embed_lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(folder, ".cache.db"), check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS prompts ("
+            "id INTEGER PRIMARY KEY, prompt TEXT, embedding BLOB, "
+            "filepath TEXT, params_hash TEXT, "
+            "usage_count INTEGER DEFAULT 0, size INTEGER DEFAULT 0)"
+        )
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(prompts)")}
+        for column in ("usage_count", "size"):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE prompts ADD COLUMN {column} INTEGER DEFAULT 0")
+        self.db.commit()
+        self._load_indexes()
         
-        if model == "dall-e-3":
-            payload["quality"] = quality
-            payload["style"] = style
+        self._inserts = 0
+        self._wake = threading.Event()
+        if max_bytes is not None:
+            threading.Thread(target=self._cache_maintainer, daemon=True).start()
+    
+    def _load_indexes(self):
+        """(Re)build the search indexes from the stored embeddings"""
+        # One flat inner-product index per settings hash, with the row ids
+        # of its entries in insertion order
+        self._indexes = {}
+        groups = {}
+        for row_id, embedding, params_hash in self.db.execute(
+                "SELECT id, embedding, params_hash FROM prompts ORDER BY id"):
+            row_ids, embeddings = groups.setdefault(params_hash, ([], []))
+            row_ids.append(row_id)
+            embeddings.append(np.frombuffer(embedding, dtype=np.float32))
+        for params_hash, (row_ids, embeddings) in groups.items():
+            self._index_add(params_hash, row_ids, np.stack(embeddings))
+    
+    @staticmethod
+    def params_hash(provider: str, params: Dict) -> str:
+        """Hash the provider and generation settings that must match exactly
+
+        The default model is filled in, as in _prepare_keys(), so omitting
+        model and naming the default one share cache entries.
+        """
+        if provider in _PROVIDERS:
+            params = {**params, 'model': params.get('model', _PROVIDERS[provider].model)}
+        key = json.dumps([provider, params], sort_keys=True, default=str)
+        return hashlib.sha1(key.encode()).hexdigest()
+    
+    def embed_many(self, prompts: List[str]):
+        """Embed prompts in batched model calls as an (n, dim) float32 array"""
+        with self._embed_lock:
+            embeddings = self._embedder.encode(prompts, batch_size=32,
+                                               normalize_embeddings=True)
+        return np.asarray(embeddings, dtype=np.float32)
+    
+    @functools.cached_property
+    def _embedder(self):
+        """Embedding model, loaded on first use and reused for the session"""
+        import torch
+        from sentence_transformers import SentenceTransformer
         
-        try:
-            print(f"🎨 Generating with OpenAI {model}...")
-            response = requests.post(
-                "https://api.openai.com/v1/images/generations",
-                headers=headers,
-                json=payload
-            )
-            response.raise_for_status()
-            data = response.json()
-            return {
-                'url': data['data'][0]['url'],
-                'provider': 'openai',
-                'model': model
-            }
-        except Exception as e:
-            print(f"❌ OpenAI Error: {e}")
-            if hasattr(e, 'response') and hasattr(e.response, 'text'):
-                print(f"Response: {e.response.text}")
-            return None
+        # Leave half the cores to the HTTP/download side of batch runs
+        torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+        return SentenceTransformer(self.model_name, device='cpu')
     
-    def generate_grok(self, prompt: str, model="grok-2-vision-1212", size="1024x1024",
-                     quality="medium", style="natural") -> Optional[Dict]:
-        """Generate image using Grok (X.AI)"""
-        if 'grok' not in self.providers:
-            print("❌ Grok API key not configured")
-            return None
+    def _index_add(self, params_hash: str, new_ids: List[int], embeddings):
+        """Append an (n, dim) block of embeddings to a settings hash's index
+
+        Callers pass whole batches so the numpy fallback copies the
+        matrix once per call rather than once per row.
+        """
+        index, row_ids = self._indexes.get(params_hash, (None, []))
+        if faiss is not None:
+            if index is None:
+                index = faiss.IndexFlatIP(embeddings.shape[1])
+            index.add(embeddings)
+        else:
+            index = embeddings if index is None else np.concatenate([index, embeddings])
+        row_ids.extend(new_ids)
+        self._indexes[params_hash] = (index, row_ids)
+    
+    def _search(self, params_hash: str, embeddings) -> List[Tuple[float, Optional[int]]]:
+        """Return (similarity, row id) of the closest entry for each embedding"""
+        if params_hash not in self._indexes:
+            return [(0.0, None)] * len(embeddings)
+        index, row_ids = self._indexes[params_hash]
+        if faiss is not None:
+            D, I = index.search(embeddings, 1)
+            scores, best = D[:, 0], I[:, 0]
+        else:
+            similarities = embeddings @ index.T
+            best = similarities.argmax(axis=1)
+            scores = similarities[np.arange(len(best)), best]
+        return [(float(score), row_ids[i]) for score, i in zip(scores, best)]
+    
+    def lookup_many(self, prompts: List[str], params_hash: str):
+        """Return (cached path or None for each prompt, the prompt embeddings)
+
+        All prompts are embedded and searched in one batch; the embeddings
+        can be passed back to add_many() for the misses.
+        """
+        embeddings = self.embed_many(prompts)
+        with self._lock:
+            hits, dead = [], []
+            for score, row_id in self._search(params_hash, embeddings):
+                row = None
+                if row_id is not None and score >= self.threshold:
+                    row = self.db.execute("SELECT filepath FROM prompts WHERE id = ?",
+                                          (row_id,)).fetchone()
+                if row and os.path.exists(row[0]):
+                    self.db.execute("UPDATE prompts SET usage_count = usage_count + 1 "
+                                    "WHERE id = ?", (row_id,))
+                    hits.append(row[0])
+                else:
+                    if row:
+                        dead.append(row_id)
+                    hits.append(None)
+            if dead:
+                # The image was deleted outside the cache; forget it
+                self.db.executemany("DELETE FROM prompts WHERE id = ?", [(r,) for r in dead])
+            self.db.commit()
+            if dead:
+                self._load_indexes()
+        return hits, embeddings
+    
+    def touch(self, filepaths: List[str]):
+        """Count exact repeats served from disk as uses of their cache rows"""
+        with self._lock:
+            self.db.executemany("UPDATE prompts SET usage_count = usage_count + 1 "
+                                "WHERE filepath = ?", [(f,) for f in filepaths])
+            self.db.commit()
+    
+    def lookup(self, prompt: str, params_hash: str) -> Optional[str]:
+        """Return a cached image path for a similar prompt, if any"""
+        return self.lookup_many([prompt], params_hash)[0][0]
+    
+    def add_many(self, prompts: List[str], filepaths: List[str], params_hash: str,
+                 embeddings=None):
+        """Record freshly downloaded images in one transaction"""
+        if embeddings is None:
+            embeddings = self.embed_many(prompts)
+        with self._lock:
+            new_ids, added = [], []
+            for prompt, filepath, embedding in zip(prompts, filepaths, embeddings):
+                try:
+                    size = os.path.getsize(filepath)
+                except OSError:  # deleted since the download, nothing to cache
+                    continue
+                cursor = self.db.execute(
+                    "INSERT INTO prompts (prompt, embedding, filepath, params_hash, size) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (prompt, embedding.tobytes(), filepath, params_hash, size)
+                )
+                new_ids.append(cursor.lastrowid)
+                added.append(embedding)
+            self.db.commit()
+            if new_ids:
+                self._index_add(params_hash, new_ids, np.stack(added))
+            self._inserts += len(new_ids)
+            if self._inserts >= self.EVICT_EVERY:
+                self._inserts = 0
+                self._wake.set()
+    
+    def add(self, prompt: str, filepath: str, params_hash: str):
+        """Record a freshly downloaded image"""
+        self.add_many([prompt], [filepath], params_hash)
+    
+    def _cache_maintainer(self):
+        """Background loop: run evict() every EVICT_EVERY inserts"""
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                self.evict()
+            except Exception as e:
+                print(f"⚠️  Cache eviction error: {e}")
+    
+    def evict(self) -> int:
+        """Delete cached images until they fit in max_bytes; returns rows removed
+
+        Entries are ranked by (usage_count + 1) / (1 + distance to the
+        nearest k-means centroid), lowest first. With scikit-learn missing
+        or fewer than MIN_CLUSTER_ROWS rows, usage counts alone decide,
+        oldest first among ties. Rows whose image no longer exists are
+        dropped without counting toward the budget.
+        """
+        if self.max_bytes is None:
+            return 0
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT id, embedding, filepath, usage_count, size FROM prompts ORDER BY id"
+            ).fetchall()
+        removed = [row[0] for row in rows if not os.path.exists(row[2])]
+        rows = [row for row in rows if os.path.exists(row[2])]
+        total = sum(row[4] for row in rows)
         
-        headers = {
-            "Authorization": f"Bearer {self.providers['grok']}",
-            "Content-Type": "application/json"
-        }
+        if total > self.max_bytes:
+            usage = np.array([row[3] for row in rows], dtype=np.float32) + 1
+            if MiniBatchKMeans is not None and len(rows) >= self.MIN_CLUSTER_ROWS:
+                embeddings = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+                n_clusters = max(1, min(self.N_CLUSTERS, len(rows) // 10))
+                kmeans = MiniBatchKMeans(n_clusters=n_clusters, n_init=3)
+                distance = kmeans.fit(embeddings).transform(embeddings).min(axis=1)
+                scores = usage / (1 + distance)
+            else:
+                scores = usage
+            
+            for i in np.argsort(scores, kind='stable'):
+                if total <= self.max_bytes:
+                    break
+                row_id, _, filepath, _, size = rows[i]
+                _delete_image(filepath)
+                removed.append(row_id)
+                total -= size
+        if not removed:
+            return 0
         
-        payload = {
-            "model": model,
-            "prompt": prompt,
-            "n": 1,
-            "size": size,
-            "quality": quality,
-            "style": style
-        }
+        with self._lock:
+            self.db.executemany("DELETE FROM prompts WHERE id = ?", [(r,) for r in removed])
+            self.db.commit()
+            self._load_indexes()
+        print(f"🧹 Prompt cache: evicted {len(removed)} images")
+        return len(removed)
+
+
+class UniversalImageGenerator:
+    def __init__(self, download_folder="ai_generated_images",
+                 rate_limits: Optional[Dict[str, int]] = None,
+                 concurrency: Optional[int] = None,
+                 cache_enabled: bool = False, cache_threshold: float = 0.92,
+                 cache_max_bytes: Optional[int] = None, http_cache: bool = False):
+        """Initialize the Universal Image Generator
+
+        rate_limits overrides the requests-per-minute budget of individual
+        providers for batch generation, e.g. {'openai': 5} on a free tier.
+        concurrency caps how many batch images are in flight at once
+        (default: min(16, 2 x configured providers)).
+        cache_enabled returns previously downloaded images for prompts whose
+        similarity to an earlier prompt is above cache_threshold.
+        cache_max_bytes, if set, lets the prompt cache delete its least
+        useful images to stay under that total size.
+        http_cache stores image download responses in HTTP_CACHE_PATH
+        (requires hishel); off by default since it duplicates image bytes.
+        """
+        self.download_folder = download_folder
+        # Absolute folder path, resolved once and joined with f-strings per file
+        self._folder = str(Path(download_folder).resolve())
+        self.providers = {}
+        self._headers = {}
+        self.rate_limits = dict(DEFAULT_RATE_LIMITS)
+        if rate_limits:
+            self.rate_limits.update({k.lower(): v for k, v in rate_limits.items()})
+        # Per event loop {provider: AdaptiveLimiter}, shared by the batches
+        # running on that loop; _rates carries the adapted rates to new loops
+        self._limiters = weakref.WeakKeyDictionary()
+        self._rates = {}
+        self.concurrency = concurrency
         
-        try:
-            print(f"🎨 Generating with Grok...")
-            response = requests.post(
-                "https://api.x.ai/v1/images/generations",
-                headers=headers,
-                json=payload
-            )
-            response.raise_for_status()
-            data = response.json()
-            return {
-                'url': data['data'][0]['url'],
-                'provider': 'grok',
-                'model': model
-            }
-        except Exception as e:
-            print(f"❌ Grok Error: {e}")
-            if hasattr(e, 'response') and hasattr(e.response, 'text'):
-                print(f"Response: {e.response.text}")
-            return None
-    
-    def generate_stability(self, prompt: str, model="stable-diffusion-xl-1024-v1-0",
-                          width=1024, height=1024, steps=30, cfg_scale=7) -> Optional[Dict]:
-        """Generate image using Stability AI"""
-        if 'stability' not in self.providers:
-            print("❌ Stability AI API key not configured")
-            return None
+        # One pooled client for every call so connections are reused (and
+        # multiplexed over HTTP/2 when h2 is installed). Transport retries only
+        # cover failed connects, so billable generation POSTs are never repeated.
+        self.client = httpx.Client(
+            transport=httpx.HTTPTransport(http2=HTTP2, limits=HTTP_LIMITS, retries=3),
+            timeout=POST_TIMEOUT,
+            follow_redirects=True
+        )
         
-        headers = {
-            "Authorization": f"Bearer {self.providers['stability']}",
-            "Content-Type": "application/json",
-            "Accept": "application/json"
-        }
+        Path(self._folder).mkdir(parents=True, exist_ok=True)
+        print(f"✓ Download folder: {self.download_folder}")
         
-        payload = {
-            "text_prompts": [{"text": prompt}],
-            "cfg_scale": cfg_scale,
-            "height": height,
-            "width": width,
-            "steps": steps,
-            "samples": 1
-        }
+        # Image downloads (CDN GETs) use their own client, backed by an on-disk
+        # HTTP cache when http_cache is set. API calls and Replicate polls
+        # go through self.client and are never cached.
+        self._http_cache = None
+        if http_cache:
+            if hishel is None:
+                print("⚠️  HTTP download cache requires: pip install hishel")
+            else:
+                HTTP_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+                self._http_cache = str(HTTP_CACHE_PATH)
+        self.download_client = httpx.Client(
+            transport=self._download_transport(),
+            timeout=GET_TIMEOUT,
+            follow_redirects=True
+        )
+        
+        # Request key -> file for images already in the folder, so repeating
+        # an identical request skips the API
+        self._existing_keys = {}
+        with os.scandir(self._folder) as entries:
+            for entry in entries:
+                match = _KEY_RE.search(entry.name)
+                if match:
+                    self._existing_keys[match.group(1)] = entry.path
         
+        self.prompt_cache = None
+        self.cache_enabled = cache_enabled
+        if cache_enabled:
+            if not HAS_EMBEDDER:
+                print("⚠️  Prompt cache requires: pip install numpy sentence-transformers")
+                self.cache_enabled = False
+            else:
+                self.prompt_cache = PromptCache(self._folder, cache_threshold,
+                                                max_bytes=cache_max_bytes)
+                print("✓ Prompt cache enabled")
+    
+    def close(self):
+        """Close pooled HTTP connections"""
+        self.client.close()
+        self.download_client.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def _cache_policy(self):
+        return hishel.SpecificationPolicy(
+            cache_options=hishel.CacheOptions(shared=False, supported_methods=["GET"])
+        )
+    
+    def _download_transport(self) -> httpx.BaseTransport:
+        """Transport for image downloads, cached on disk when http_cache is set"""
+        transport = httpx.HTTPTransport(http2=HTTP2, limits=HTTP_LIMITS, retries=3)
+        if self._http_cache is None:
+            return transport
+        storage = hishel.SyncSqliteStorage(database_path=self._http_cache,
+                                           default_ttl=HTTP_CACHE_TTL)
+        return SyncCacheTransport(next_transport=transport, storage=storage,
+                                  policy=self._cache_policy())
+    
+    def _download_transport_async(self) -> httpx.AsyncBaseTransport:
+        """Async variant of _download_transport"""
+        transport = httpx.AsyncHTTPTransport(http2=HTTP2, limits=HTTP_LIMITS, retries=3)
+        if self._http_cache is None:
+            return transport
         try:
-            print(f"🎨 Generating with Stability AI...")
-            response = requests.post(
-                f"https://api.stability.ai/v1/generation/{model}/text-to-image",
-                headers=headers,
-                json=payload
-            )
-            response.raise_for_status()
-            data = response.json()
-            image_data = data['artifacts'][0]['base64']
-            return {
-                'base64': image_data,
-                'provider': 'stability',
-                'model': model
-            }
-        except Exception as e:
-            print(f"❌ Stability AI Error: {e}")
-            if hasattr(e, 'response') and hasattr(e.response, 'text'):
-                print(f"Response: {e.response.text}")
-            return None
+            storage = hishel.AsyncSqliteStorage(database_path=self._http_cache,
+                                                default_ttl=HTTP_CACHE_TTL)
+        except ImportError:  # async storage needs: pip install "hishel[async]"
+            return transport
+        return AsyncCacheTransport(next_transport=transport, storage=storage,
+                                   policy=self._cache_policy())
     
-    def generate_replicate(self, prompt: str, model="stability-ai/sdxl",
-                          width=1024, height=1024, num_inference_steps=25) -> Optional[Dict]:
-        """Generate image using Replicate"""
-        if 'replicate' not in self.providers:
-            print("❌ Replicate API key not configured")
-            return None
-        
-        headers = {
-            "Authorization": f"Token {self.providers['replicate']}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "version": model,
-            "input": {
-                "prompt": prompt,
-                "width": width,
-                "height": height,
-                "num_inference_steps": num_inference_steps
+    def add_provider(self, provider_name: str, api_key: str):
+        """Add an API provider"""
+        name = provider_name.lower()
+        self.providers[name] = api_key
+        if name in _PROVIDERS:
+            spec = _PROVIDERS[name]
+            self._headers[name] = {
+                "Authorization": f"{spec.auth} {api_key}",
+                "Content-Type": "application/json",
+                **spec.headers
             }
-        }
-        
-        try:
-            print(f"🎨 Generating with Replicate...")
-            response = requests.post(
-                "https://api.replicate.com/v1/predictions",
-                headers=headers,
-                json=payload
+        print(f"✓ Added provider: {provider_name}")
+    
+    def _post_json(self, provider: str, url: str, payload: Dict) -> Union[Dict, bytes]:
+        """POST a JSON request with the provider's cached auth headers
+
+        The headers (including Content-Type) are built once in add_provider();
+        the payload is serialized with orjson when it is installed.
+
+        Returns the decoded JSON body, or the raw bytes of an image response.
+        """
+        response = self.client.post(
+            url,
+            headers=self._headers[provider],
+            content=_dumps(payload),
+            timeout=POST_TIMEOUT
+        )
+        response.raise_for_status()
+        if response.headers.get('Content-Type', '').startswith('image/'):
+            return response.content
+        return _json(response)
+    
+    def _poll_prediction(self, provider: str, prediction_url: str) -> Optional[Dict]:
+        """Wait for a Replicate prediction; returns its final status data"""
+        delay = POLL_INITIAL_DELAY
+        for _ in range(POLL_MAX_ATTEMPTS):
+            time.sleep(delay + random.uniform(0, 0.25))
+            status_response = self.client.get(
+                prediction_url, headers=self._headers[provider], timeout=POLL_TIMEOUT
             )
-            response.raise_for_status()
-            data = response.json()
+            if _poll_busy(status_response):
+                # The prediction is already running (and billed); keep polling
+                print(f"⏳ Status check returned {status_response.status_code}, retrying...")
+                delay = _next_poll_delay(delay, status_response.headers)
+                continue
+            status_response.raise_for_status()
+            status_data = _json(status_response)
             
-            prediction_url = data['urls']['get']
-            while True:
-                time.sleep(2)
-                status_response = requests.get(prediction_url, headers=headers)
-                status_data = status_response.json()
-                
-                if status_data['status'] == 'succeeded':
-                    return {
-                        'url': status_data['output'][0] if isinstance(status_data['output'], list) else status_data['output'],
-                        'provider': 'replicate',
-                        'model': model
-                    }
-                elif status_data['status'] == 'failed':
-                    print(f"❌ Generation failed: {status_data.get('error')}")
-                    return None
-                
-                print("⏳ Waiting...")
-        except Exception as e:
-            print(f"❌ Replicate Error: {e}")
-            if hasattr(e, 'response') and hasattr(e.response, 'text'):
-                print(f"Response: {e.response.text}")
-            return None
+            if status_data['status'] == 'succeeded':
+                return status_data
+            elif status_data['status'] in ('failed', 'canceled'):
+                print(f"❌ Generation {status_data['status']}: {status_data.get('error')}")
+                return None
+            
+            print("⏳ Waiting...")
+            delay = _next_poll_delay(delay, status_response.headers)
+        
+        print("❌ Timed out waiting for prediction")
+        return None
+    
+    def _handle_err(self, provider: str, e: Exception):
+        """Report a failed provider call; the one place all error paths go through"""
+        print(f"❌ {_PROVIDERS[provider].label} Error: {e}")
+        if isinstance(e, httpx.HTTPStatusError):
+            print(f"Response: {e.response.text}")
     
-    def generate_together(self, prompt: str, model="black-forest-labs/FLUX.1-schnell",
-                         width=1024, height=1024, steps=4) -> Optional[Dict]:
-        """Generate image using Together AI"""
-        if 'together' not in self.providers:
-            print("❌ Together AI API key not configured")
+    def _generate_result(self, provider: str, prompt: str, **kwargs) -> Optional[Dict]:
+        """Call a provider from the _PROVIDERS table and return its image result"""
+        spec = _PROVIDERS[provider]
+        if provider not in self.providers:
+            print(f"❌ {spec.label} API key not configured")
             return None
         
-        headers = {
-            "Authorization": f"Bearer {self.providers['together']}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "model": model,
-            "prompt": prompt,
-            "width": width,
-            "height": height,
-            "steps": steps,
-            "n": 1
-        }
+        model = kwargs.pop('model', spec.model)
+        payload = spec.build(prompt, model, **kwargs)
         
         try:
-            print(f"🎨 Generating with Together AI...")
-            response = requests.post(
-                "https://api.together.xyz/v1/images/generations",
-                headers=headers,
-                json=payload
-            )
-            response.raise_for_status()
-            data = response.json()
-            return {
-                'url': data['data'][0]['url'],
-                'provider': 'together',
-                'model': model
-            }
-        except Exception as e:
-            print(f"❌ Together AI Error: {e}")
-            if hasattr(e, 'response') and hasattr(e.response, 'text'):
-                print(f"Response: {e.response.text}")
+            print(f"🎨 Generating with {spec.label} {model}...")
+            data = self._post_json(provider, spec.url.format(model=model), payload)
+            if isinstance(data, bytes):
+                return {'raw': data, 'provider': provider, 'model': model}
+            if spec.poll:
+                data = self._poll_prediction(provider, data['urls']['get'])
+                if data is None:
+                    return None
+            return {**spec.parse(data), 'provider': provider, 'model': model}
+        except PROVIDER_ERRORS as e:
+            self._handle_err(provider, e)
             return None
     
-    def download_image(self, result: Dict, prompt: str) -> Optional[str]:
-        """Download image and save to folder"""
+    def generate_openai(self, prompt: str, **kwargs) -> Optional[Dict]:
+        """Generate image using OpenAI DALL-E (model, size, quality, style)"""
+        return self._generate_result('openai', prompt, **kwargs)
+    
+    def generate_grok(self, prompt: str, **kwargs) -> Optional[Dict]:
+        """Generate image using Grok (X.AI) (model, size, quality, style)"""
+        return self._generate_result('grok', prompt, **kwargs)
+    
+    def generate_stability(self, prompt: str, **kwargs) -> Optional[Dict]:
+        """Generate image using Stability AI (model, width, height, steps, cfg_scale)"""
+        return self._generate_result('stability', prompt, **kwargs)
+    
+    def generate_replicate(self, prompt: str, **kwargs) -> Optional[Dict]:
+        """Generate image using Replicate (model, width, height, num_inference_steps)"""
+        return self._generate_result('replicate', prompt, **kwargs)
+    
+    def generate_together(self, prompt: str, **kwargs) -> Optional[Dict]:
+        """Generate image using Together AI (model, width, height, steps)"""
+        return self._generate_result('together', prompt, **kwargs)
+    
+    def _image_path(self, result: Dict, prompt: str, key: Optional[str] = None,
+                    safe_prompt: Optional[str] = None) -> str:
+        """Build the download path: <timestamp>_<provider>_<prompt>[_<key>].png"""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        if safe_prompt is None:
+            safe_prompt = _safe_name(prompt)
+        provider = result.get('provider', 'unknown')
+        filename = f"{timestamp}_{provider}_{safe_prompt}"
+        if key:
+            filename += f"_{key}"
+        return f"{self._folder}{os.sep}{filename}.png"
+    
+    def download_image(self, result: Dict, prompt: str, key: Optional[str] = None,
+                       safe_prompt: Optional[str] = None) -> Optional[str]:
+        """Download image and save to folder
+
+        Image bytes are streamed to disk in CHUNK_SIZE blocks rather than
+        held in memory. key, if given, is the request key appended to the
+        filename; safe_prompt is the precomputed filename form of prompt.
+        """
+        filepath = None
         try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            safe_prompt = "".join(c for c in prompt[:50] if c.isalnum() or c in (' ', '-', '_')).strip()
-            safe_prompt = safe_prompt.replace(' ', '_')
-            provider = result.get('provider', 'unknown')
-            filename = f"{timestamp}_{provider}_{safe_prompt}.png"
-            filepath = os.path.join(self.download_folder, filename)
-            
+            filepath = self._image_path(result, prompt, key, safe_prompt)
             if 'url' in result:
                 print(f"⬇️  Downloading...")
-                img_response = requests.get(result['url'])
-                img_response.raise_for_status()
-                image_data = img_response.content
-            elif 'base64' in result:
-                print(f"⬇️  Decoding...")
-                image_data = base64.b64decode(result['base64'])
-            else:
-                print("❌ No image data")
+                with self.download_client.stream('GET', result['url']) as img_response:
+                    img_response.raise_for_status()
+                    with _open_image(filepath) as fd:
+                        for chunk in img_response.iter_bytes(CHUNK_SIZE):
+                            _write_all(fd, chunk)
+            elif not _save_inline(result, filepath):
                 return None
             
-            with open(filepath, 'wb') as f:
-                f.write(image_data)
-            
             print(f"✓ Saved: {filepath}")
             return filepath
-        except Exception as e:
+        except DOWNLOAD_ERRORS as e:
             print(f"❌ Download error: {e}")
+            _remove_partial(filepath)
             return None
     
+    def _prepare_keys(self, provider: str, prompts: List[str],
+                      params: Dict) -> List[Tuple[str, str]]:
+        """Return (safe filename prompt, request key) for each prompt
+
+        The key is a short digest of provider, model, settings and prompt.
+        Settings are shared by every prompt in a call, so they are hashed
+        once and the digest state is copied per prompt.
+        """
+        spec = _PROVIDERS[provider]
+        model = params.get('model', spec.model)
+        settings = sorted((k, v) for k, v in params.items() if k != 'model')
+        base = hashlib.blake2b(f"{provider}|{model}|{settings}|".encode(), digest_size=8)
+        prepared = []
+        for prompt in prompts:
+            h = base.copy()
+            h.update(prompt.encode())
+            prepared.append((_safe_name(prompt), h.hexdigest()))
+        return prepared
+    
+    def _existing_image(self, key: str) -> Optional[str]:
+        """Return the path of an identical earlier image, if still on disk"""
+        filepath = self._existing_keys.get(key)
+        if filepath and os.path.exists(filepath):
+            print(f"♻️  Already generated: {filepath}")
+            return filepath
+        return None
+    
+    def _cache_lookup(self, provider: str, prompt: str, params: Dict):
+        """Return (cached filepath or None, params hash) for a request"""
+        if not self.cache_enabled:
+            return None, None
+        params_hash = self.prompt_cache.params_hash(provider, params)
+        cached = self.prompt_cache.lookup(prompt, params_hash)
+        if cached:
+            print(f"♻️  Cache hit: {cached}")
+        return cached, params_hash
+    
     def generate(self, provider: str, prompt: str, **kwargs) -> Optional[str]:
         """Generate and download image"""
         provider = provider.lower()
-        
-        if provider == 'openai':
-            result = self.generate_openai(prompt, **kwargs)
-        elif provider == 'grok':
-            result = self.generate_grok(prompt, **kwargs)
-        elif provider == 'stability':
-            result = self.generate_stability(prompt, **kwargs)
-        elif provider == 'replicate':
-            result = self.generate_replicate(prompt, **kwargs)
-        elif provider == 'together':
-            result = self.generate_together(prompt, **kwargs)
-        else:
+        if provider not in _PROVIDERS:
             print(f"❌ Unknown provider: {provider}")
             return None
         
+        # Invalid prompts would only earn a 400 after a full round-trip; the
+        # stripped prompt is also what the request key and cache store
+        prompt = _clean_prompt(prompt)
+        if prompt is None:
+            return None
+        
+        safe_prompt, key = self._prepare_keys(provider, [prompt], kwargs)[0]
+        existing = self._existing_image(key)
+        if existing:
+            if self.cache_enabled:
+                self.prompt_cache.touch([existing])
+            return existing
+        
+        cached, params_hash = self._cache_lookup(provider, prompt, kwargs)
+        if cached:
+            return cached
+        
+        result = self._generate_result(provider, prompt, **kwargs)
         if result:
-            return self.download_image(result, prompt)
+            filepath = self.download_image(result, prompt, key, safe_prompt)
+            if filepath:
+                self._existing_keys[key] = filepath
+                if self.cache_enabled:
+                    self.prompt_cache.add(prompt, filepath, params_hash)
+            return filepath
         return None
 
+    def compare_providers(self, prompt: str) -> Dict[str, Optional[str]]:
+        """Generate the same prompt with every configured provider in parallel
+
+        Providers are independent services, so total time is that of the
+        slowest one. Returns {provider: filepath or None}.
+        """
+        providers = [p for p in self.providers if p in _PROVIDERS]
+        if not providers:
+            print("❌ No providers configured")
+            return {}
+        if _clean_prompt(prompt) is None:
+            return {}
+        
+        results = {}
+        with ThreadPoolExecutor(max_workers=len(providers)) as executor:
+            futures = {executor.submit(self.generate, p, prompt): p for p in providers}
+            for future in as_completed(futures):
+                provider = futures[future]
+                results[provider] = future.result()
+                status = results[provider] or "failed"
+                print(f"{'✓' if results[provider] else '❌'} {provider}: {status}")
+        return results
+
+    # ------------------------------------------------------------------
+    # Async batch generation
+    # ------------------------------------------------------------------
+
+    def _loop_limiters(self) -> Dict[str, Any]:
+        """Rate limiters for the running event loop, created on first use
+
+        asyncio primitives are bound to one loop, so each loop gets its own
+        limiters; they start from the rates earlier loops adapted down to.
+        """
+        loop = asyncio.get_running_loop()
+        limiters = self._limiters.get(loop)
+        if limiters is None:
+            limiters = {}
+            for name, rpm in self.rate_limits.items():
+                limiters[name] = AdaptiveLimiter(rpm, 60)
+                limiters[name]._set_rate(min(rpm, self._rates.get(name, rpm)))
+            self._limiters[loop] = limiters
+        return limiters
+
+    async def _post_json_async(self, client, limiter, provider: str, url: str,
+                               payload: Dict) -> Union[Dict, bytes]:
+        """POST a generation request, retrying when the provider returns 429"""
+        for attempt in range(RETRY_ATTEMPTS):
+            try:
+                return await self._post_json_once_async(client, limiter, provider, url, payload)
+            except RetryNeeded as e:
+                if attempt == RETRY_ATTEMPTS - 1:
+                    raise
+                delay = max(e.delay, RETRY_BACKOFF * 2 ** attempt)
+                print(f"⏳ {e}, retrying in {delay:.0f}s...")
+                await asyncio.sleep(delay)
+
+    async def _post_json_once_async(self, client, limiter, provider: str, url: str,
+                                    payload: Dict) -> Union[Dict, bytes]:
+        """POST a generation request, paced by the provider's rate limiter"""
+        async with limiter:
+            response = await client.post(
+                url, headers=self._headers[provider], content=_dumps(payload)
+            )
+        if response.status_code == 429:
+            limiter.adjust_down()
+            raise RetryNeeded(provider, _retry_after(response.headers))
+        response.raise_for_status()
+        limiter.adjust_up()
+        if response.headers.get('Content-Type', '').startswith('image/'):
+            return response.content
+        return _json(response)
+
+    async def _poll_prediction_async(self, client, provider: str,
+                                     prediction_url: str) -> Optional[Dict]:
+        """Async variant of _poll_prediction"""
+        delay = POLL_INITIAL_DELAY
+        for _ in range(POLL_MAX_ATTEMPTS):
+            await asyncio.sleep(delay + random.uniform(0, 0.25))
+            status_response = await client.get(
+                prediction_url, headers=self._headers[provider], timeout=POLL_TIMEOUT
+            )
+            if _poll_busy(status_response):
+                delay = _next_poll_delay(delay, status_response.headers)
+                continue
+            status_response.raise_for_status()
+            status_data = _json(status_response)
+            
+            if status_data['status'] == 'succeeded':
+                return status_data
+            elif status_data['status'] in ('failed', 'canceled'):
+                print(f"❌ Generation {status_data['status']}: {status_data.get('error')}")
+                return None
+            
+            delay = _next_poll_delay(delay, status_response.headers)
+        
+        print("❌ Timed out waiting for prediction")
+        return None
+
+    async def _generate_result_async(self, client, limiter, provider: str, prompt: str,
+                                     **kwargs) -> Optional[Dict]:
+        """Async variant of _generate_result"""
+        spec = _PROVIDERS[provider]
+        model = kwargs.pop('model', spec.model)
+        payload = spec.build(prompt, model, **kwargs)
+        
+        try:
+            data = await self._post_json_async(
+                client, limiter, provider, spec.url.format(model=model), payload
+            )
+            if isinstance(data, bytes):
+                return {'raw': data, 'provider': provider, 'model': model}
+            if spec.poll:
+                data = await self._poll_prediction_async(client, provider, data['urls']['get'])
+                if data is None:
+                    return None
+            return {**spec.parse(data), 'provider': provider, 'model': model}
+        except PROVIDER_ERRORS as e:
+            self._handle_err(provider, e)
+            return None
+
+    async def _download_image_async(self, download_client, result: Dict, prompt: str,
+                                    key: Optional[str] = None,
+                                    safe_prompt: Optional[str] = None) -> Optional[str]:
+        """Async variant of download_image"""
+        filepath = None
+        try:
+            filepath = self._image_path(result, prompt, key, safe_prompt)
+            if 'url' in result:
+                async with download_client.stream('GET', result['url']) as img_response:
+                    img_response.raise_for_status()
+                    with _open_image(filepath) as fd:
+                        async for chunk in img_response.aiter_bytes(CHUNK_SIZE):
+                            _write_all(fd, chunk)
+            elif not _save_inline(result, filepath):
+                return None
+            
+            print(f"✓ Saved: {filepath}")
+            return filepath
+        except DOWNLOAD_ERRORS as e:
+            print(f"❌ Download error: {e}")
+            _remove_partial(filepath)
+            return None
+
+    async def _generate_async(self, client, download_client, sem, limiter, provider: str,
+                              prompt: str, prepared: Tuple[str, str], **kwargs) -> Optional[str]:
+        """Generate and download one image inside a batch
+
+        prompt has already been validated and checked against existing files
+        and the prompt cache; prepared holds its (safe filename prompt,
+        request key) from _prepare_keys(). sem and limiter belong to the
+        calling batch.
+        """
+        safe_prompt, key = prepared
+        
+        # Held for the whole job (request, polling and download), so at most
+        # self.concurrency images are in flight however many are queued
+        async with sem:
+            result = await self._generate_result_async(client, limiter, provider, prompt,
+                                                       **kwargs)
+            if not result:
+                return None
+            filepath = await self._download_image_async(download_client, result, prompt,
+                                                        key, safe_prompt)
+        
+        if filepath:
+            self._existing_keys[key] = filepath
+        return filepath
+
+    async def generate_batch(self, provider: str, prompts: List[str], **kwargs) -> List[Optional[str]]:
+        """Generate one image per prompt concurrently
+
+        Two limits apply: a semaphore bounds how many images are in flight
+        (self.concurrency), and the provider's leaky-bucket limiter bounds how
+        fast new requests start (self.rate_limits, requests per minute).
+        Returns file paths (None on failure) in prompt order.
+        """
+        if AsyncLimiter is None:
+            print("❌ Batch generation requires: pip install aiolimiter")
+            return [None] * len(prompts)
+        
+        provider = provider.lower()
+        if provider not in _PROVIDERS:
+            print(f"❌ Unknown provider: {provider}")
+            return [None] * len(prompts)
+        if provider not in self.providers:
+            print(f"❌ {provider} API key not configured")
+            return [None] * len(prompts)
+        
+        limiter = self._loop_limiters()[provider]
+        sem = asyncio.Semaphore(self.concurrency or min(16, 2 * len(self.providers)))
+        
+        # Validate, sanitize and hash the whole batch up front so the
+        # concurrent jobs only wait on the network
+        prompts = [_clean_prompt(p) for p in prompts]
+        valid = [i for i, p in enumerate(prompts) if p]
+        prepared = dict(zip(valid, self._prepare_keys(provider, [prompts[i] for i in valid], kwargs)))
+        results = [None] * len(prompts)
+        todo = []
+        for i in valid:
+            results[i] = self._existing_image(prepared[i][1])
+            if results[i] is None:
+                todo.append(i)
+        if self.cache_enabled and len(todo) < len(valid):
+            self.prompt_cache.touch([results[i] for i in valid if results[i]])
+        
+        # One batched embedding pass and index search for the rest
+        embeddings = {}
+        if self.cache_enabled and todo:
+            params_hash = self.prompt_cache.params_hash(provider, kwargs)
+            hits, batch_embeddings = self.prompt_cache.lookup_many(
+                [prompts[i] for i in todo], params_hash
+            )
+            misses = []
+            for i, hit, embedding in zip(todo, hits, batch_embeddings):
+                if hit:
+                    print(f"♻️  Cache hit: {hit}")
+                    results[i] = hit
+                else:
+                    misses.append(i)
+                    embeddings[i] = embedding
+            todo = misses
+        
+        if not todo:
+            return results
+        
+        # Identical requests inside the batch share one job and one file
+        by_key = {}
+        for i in todo:
+            by_key.setdefault(prepared[i][1], []).append(i)
+        todo = [same[0] for same in by_key.values()]
+        
+        print(f"🎨 Generating {len(todo)} images with {provider}...")
+        transport = httpx.AsyncHTTPTransport(http2=HTTP2, limits=HTTP_LIMITS, retries=3)
+        async with httpx.AsyncClient(transport=transport, timeout=POST_TIMEOUT,
+                                     follow_redirects=True) as client, \
+                httpx.AsyncClient(transport=self._download_transport_async(),
+                                  timeout=GET_TIMEOUT, follow_redirects=True) as download_client:
+            # An unexpected error in one job must not discard the images the
+            # others already saved
+            filepaths = await asyncio.gather(
+                *[self._generate_async(client, download_client, sem, limiter, provider,
+                                       prompts[i], prepared[i], **kwargs)
+                  for i in todo],
+                return_exceptions=True
+            )
+        self._rates[provider] = limiter.max_rate
+        
+        done = []
+        for i, filepath in zip(todo, filepaths):
+            if isinstance(filepath, BaseException):
+                print(f"❌ {prompts[i][:50]}: {filepath!r}")
+                filepath = None
+            for j in by_key[prepared[i][1]]:
+                results[j] = filepath
+            if filepath:
+                done.append(i)
+        if self.cache_enabled and done:
+            self.prompt_cache.add_many(
+                [prompts[i] for i in done], [results[i] for i in done],
+                params_hash, [embeddings[i] for i in done]
+            )
+        return results
+
+    def generate_many(self, provider: str, prompts: List[str], **kwargs) -> List[Optional[str]]:
+        """Generate one image per prompt concurrently from synchronous code
+
+        Runs generate_batch() in its own event loop; from async code, await
+        generate_batch() directly. Returns file paths (None on failure) in
+        prompt order.
+        """
+        return asyncio.run(self.generate_batch(provider, prompts, **kwargs))
+
 
 def main():
     """Main interactive function"""
@@ -350,8 +1304,8 @@ def main():
         print("\n" + "-" * 70)
         
         if len(generator.providers) > 1:
-            provider = input(f"\n🤖 Provider ({'/'.join(generator.providers.keys())}): ").strip().lower()
-            if provider not in generator.providers:
+            provider = input(f"\n🤖 Provider ({'/'.join(generator.providers.keys())}/all): ").strip().lower()
+            if provider not in generator.providers and provider != 'all':
                 provider = list(generator.providers.keys())[0]
                 print(f"Using: {provider}")
         else:
@@ -368,6 +1322,12 @@ def main():
             print("⚠️  Empty prompt!")
             continue
         
+        if provider == 'all':
+            results = generator.compare_providers(prompt)
+            image_count += sum(1 for f in results.values() if f)
+            print(f"\n✅ Total: {image_count}")
+            continue
+        
         kwargs = {}
         custom = input("Custom settings? (y/n): ").strip().lower()
         
@@ -399,6 +1359,8 @@ def main():
             print("\n⚠️  Failed!")
         
         time.sleep(1)
+    
+    generator.close()
 
 
 if __name__ == "__main__":